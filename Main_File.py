@@ -4,18 +4,27 @@ Supports price-time priority, market/limit/IOC/FOK orders.
 FastAPI REST for order entry, WebSocket for trade events, MongoDB persistence, OAuth2 auth.
 """
 
-from fastapi import FastAPI, WebSocket, HTTPException, status, Depends
+from fastapi import FastAPI, WebSocket, HTTPException, Request, status, Depends
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from typing import List, Dict, Union
-from collections import deque
-from sortedcontainers import SortedDict  # SortedDict for price-level management:contentReference[oaicite:0]{index=0}
+from typing import List, Dict, Set, Union
+from decimal import Decimal
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from sortedcontainers import SortedList
 import uuid
+import os
 import asyncio
+import time
 import datetime
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import orjson
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # OAuth2 password flow setup with token URL "token" (FastAPI example):contentReference[oaicite:1]{index=1}
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -34,19 +43,140 @@ class OrderIn(BaseModel):
 class CancelOrder(BaseModel):
     order_id: str
 
-# MongoDB setup (local instance)
-client = AsyncIOMotorClient("mongodb://localhost:27017")
-db = client["exchange"]
+class RestingOrder:
+    """
+    Resting order, linked intrusively into its price level's FIFO queue.
+    """
+    __slots__ = ('order_id', 'qty', 'user', 'symbol', 'side', 'prev', 'next', 'level')
+
+    def __init__(self, order_id: str, qty: int, user: str, symbol: str, side: str):
+        self.order_id = order_id
+        self.qty = qty
+        self.user = user
+        self.symbol = symbol
+        self.side = side
+        self.prev = None
+        self.next = None
+        self.level = None
+
+class PriceLevel:
+    """
+    FIFO queue of resting orders at one price (doubly-linked), plus aggregated size.
+    """
+    __slots__ = ('price', 'total', 'head', 'tail')
+
+    def __init__(self, price: int):
+        self.price = price
+        self.total = 0
+        self.head = None
+        self.tail = None
+
+    def append(self, node: RestingOrder):
+        # Newest order goes to the back of the queue (time priority)
+        node.level = self
+        node.prev = self.tail
+        if self.tail is None:
+            self.head = node
+        else:
+            self.tail.next = node
+        self.tail = node
+        self.total += node.qty
+
+    def unlink(self, node: RestingOrder):
+        # O(1) removal from anywhere in the queue
+        if node.prev is None:
+            self.head = node.next
+        else:
+            node.prev.next = node.next
+        if node.next is None:
+            self.tail = node.prev
+        else:
+            node.next.prev = node.prev
+        self.total -= node.qty
+        node.prev = node.next = node.level = None
+
+class IdGen:
+    """
+    Random 128-bit hex ids sliced from a bulk os.urandom buffer (one syscall per 4096 ids).
+    """
+    BUF_SIZE = 1 << 16
+
+    def __init__(self):
+        self.buf = os.urandom(self.BUF_SIZE)
+        self.pos = 0
+
+    def next_hex(self) -> str:
+        if self.pos >= len(self.buf):
+            self.buf = os.urandom(self.BUF_SIZE)
+            self.pos = 0
+        out = self.buf[self.pos:self.pos + 16].hex()
+        self.pos += 16
+        return out
+
+idgen = IdGen()
+
+# MongoDB setup (local instance). Warm, large pools and no retryable writes keep per-write
+# latency low; clients only connect on first use, so shard processes never open pools.
+MONGO_URI = "mongodb://localhost:27017"
+MONGO_POOL_OPTIONS = dict(maxPoolSize=200, minPoolSize=50, retryWrites=False, compressors="zstd")
+# Order state is acknowledged (w=1): later status updates depend on earlier inserts landing
+durable_client = AsyncIOMotorClient(MONGO_URI, w=1, **MONGO_POOL_OPTIONS)
+# Trades are append-only history, written unacknowledged
+fast_client = AsyncIOMotorClient(MONGO_URI, w=0, journal=False, **MONGO_POOL_OPTIONS)
+db = durable_client["exchange"]
 orders_collection = db["orders"]
 trades_collection = db["trades"]
 
-# In-memory order books: symbol -> {'bids': SortedDict, 'asks': SortedDict}
-order_books: Dict[str, Dict[str, SortedDict]] = {}
-# Map order_id -> order data (for cancellation lookup)
-order_map: Dict[str, Dict] = {}
+# Persistence is asynchronous: handlers enqueue (collection, op, doc) tuples and a
+# background task flushes them, so the in-memory book is the source of truth.
+# Queued collection names map to the client each kind of write goes through.
+write_collections = {
+    "orders": orders_collection,
+    "trades": fast_client["exchange"]["trades"],
+}
+write_q: asyncio.Queue = asyncio.Queue()
+WRITE_BATCH_SIZE = 500       # max queued writes flushed per batch
+WRITE_BATCH_TIMEOUT = 0.005  # seconds to wait for more writes before flushing
+writer_task: Union[asyncio.Task, None] = None
+
+# Price/quantity grids per symbol, as integer counts per whole unit (100 -> 0.01 tick).
+# The book works purely in integer ticks and lots; floats only appear at ingress and in
+# outbound trades/documents, where dividing by the integer count gives the exact
+# nearest float (100.07, not 10007 * 0.01 = 100.07000000000001).
+DEFAULT_TICKS_PER_UNIT = 100
+DEFAULT_LOTS_PER_UNIT = 100_000_000
+ticks_per_unit: Dict[str, int] = {}  # symbol -> tick grid override
+lots_per_unit: Dict[str, int] = {}   # symbol -> lot grid override
+MAX_UNITS = 2 ** 63 - 1  # ticks/lots must fit in an int64
+
+# In-memory order books: symbol -> {'bid_prices', 'ask_prices', 'bid_levels', 'ask_levels', 'best_bid', 'best_ask'}
+# Levels dicts map price -> level; the sorted price lists hold exactly the active prices.
+# best_bid/best_ask cache the top of book and are refreshed only when a level at the top changes.
+# Each price level is a PriceLevel holding its resting orders and aggregate resting lots
+order_books: Dict[str, dict] = {}
+# Map order_id -> resting order node (for O(1) cancellation)
+order_map: Dict[str, RestingOrder] = {}
+
+# Upper bound on pooled PriceLevel objects kept per symbol
+LEVEL_POOL_MAX = 1024
+
+# Matching shards: each is a single-process executor owning the books of the symbols
+# hashed to it, so its FIFO task queue is the single writer for those books.
+# Each command costs a pickle + IPC round trip, so sharding only pays off with at least
+# two shards: with MATCH_SHARDS < 2 matching stays in the web process and
+# order_books/order_map above are this process's books; otherwise they live in the shards.
+MATCH_SHARDS = int(os.environ.get("MATCH_SHARDS", os.cpu_count() or 1))
+shards: List[ProcessPoolExecutor] = []
+# Resting order_id -> symbol, so cancels can be routed to the owning shard
+order_symbols: Dict[str, str] = {}
 
 # WebSocket connections for trade events
-trade_subscribers: List[WebSocket] = []
+trade_subscribers: Set[WebSocket] = set()
+
+# Trades from one or more orders are coalesced and sent as a single frame per subscriber
+broadcast_q: asyncio.Queue = asyncio.Queue()
+BROADCAST_DEBOUNCE = 0.002  # seconds to gather trades from concurrent orders
+broadcaster_task: Union[asyncio.Task, None] = None
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
     """
@@ -76,20 +206,368 @@ def get_order_book(symbol: str):
     sym = symbol.upper()
     if sym not in order_books:
         order_books[sym] = {
-            'bids': SortedDict(),  # key: price, value: deque of orders (highest first)
-            'asks': SortedDict()   # (lowest first)
+            'bid_prices': SortedList(),  # active bid prices, ascending (best is last)
+            'ask_prices': SortedList(),  # active ask prices, ascending (best is first)
+            'bid_levels': {},  # key: price, value: price level
+            'ask_levels': {},
+            'best_bid': None,  # cached top of book
+            'best_ask': None,
+            'level_pool': []   # emptied PriceLevel objects kept for reuse
         }
     return order_books[sym]
 
-async def broadcast_trade(trade_event: dict):
+def to_units(value: float, per_unit: int, what: str) -> int:
+    """
+    Convert a client price/quantity to integer grid units. Values are never rounded:
+    non-finite, out-of-range or off-grid input is rejected with a 400.
+    """
+    # repr() gives the shortest decimal the client sent (100.006, not its binary expansion)
+    units = Decimal(repr(value)) * per_unit
+    if not units.is_finite():
+        raise HTTPException(status_code=400, detail=f"{what} must be a finite number")
+    if abs(units) > MAX_UNITS:
+        raise HTTPException(status_code=400, detail=f"{what} is out of range")
+    if units != units.to_integral_value():
+        raise HTTPException(status_code=400,
+                            detail=f"{what} must be a multiple of {Decimal(1) / per_unit:f}")
+    return int(units)
+
+def to_ticks(symbol: str, price: float) -> int:
     """
-    Broadcast trade event to all WebSocket subscribers.
+    Convert a price to integer ticks on the symbol's tick grid.
+    """
+    return to_units(price, ticks_per_unit.get(symbol, DEFAULT_TICKS_PER_UNIT), "Price")
+
+def to_lots(symbol: str, quantity: float) -> int:
+    """
+    Convert a quantity to integer lots on the symbol's lot grid.
+    """
+    return to_units(quantity, lots_per_unit.get(symbol, DEFAULT_LOTS_PER_UNIT), "Quantity")
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def iso(ns: int) -> str:
+    """
+    Render an integer-nanosecond UTC timestamp as ISO-8601 (the API's display format).
+    """
+    return (_EPOCH + datetime.timedelta(microseconds=ns // 1000)).isoformat()
+
+def get_or_create_level(book: dict, side: str, price: int):
+    """
+    Return the price level for a resting order on `side`, creating it if needed.
+    """
+    levels = book['bid_levels'] if side == "buy" else book['ask_levels']
+    level = levels.get(price)
+    if level is None:
+        pool = book['level_pool']
+        if pool:
+            # Reuse an emptied level instead of allocating a new one
+            level = pool.pop()
+            level.price = price
+        else:
+            level = PriceLevel(price)
+        levels[price] = level
+        if side == "buy":
+            book['bid_prices'].add(price)
+            if book['best_bid'] is None or price > book['best_bid']:
+                book['best_bid'] = price
+        else:
+            book['ask_prices'].add(price)
+            if book['best_ask'] is None or price < book['best_ask']:
+                book['best_ask'] = price
+    return level
+
+def remove_level(book: dict, side: str, price: int):
+    """
+    Delete an emptied level on `side`; the cached best is refreshed only if it was the top.
+    The level object is returned to the pool.
+    """
+    if side == "buy":
+        level = book['bid_levels'].pop(price)
+        prices = book['bid_prices']
+        prices.remove(price)
+        if book['best_bid'] == price:
+            book['best_bid'] = prices[-1] if prices else None
+    else:
+        level = book['ask_levels'].pop(price)
+        prices = book['ask_prices']
+        prices.remove(price)
+        if book['best_ask'] == price:
+            book['best_ask'] = prices[0] if prices else None
+    if len(book['level_pool']) < LEVEL_POOL_MAX:
+        level.total = 0
+        book['level_pool'].append(level)
+
+def can_fill(book: dict, side: str, price, qty: int) -> bool:
+    """
+    Whether an incoming `side` order for `qty` lots could fully fill at `price` or better.
+    """
+    # Walk eligible levels best-first; stop at the limit price or once enough size is found
+    available = 0
+    if side == "buy":
+        levels = book['ask_levels']
+        for p in book['ask_prices'].irange(maximum=price):
+            available += levels[p].total
+            if available >= qty:
+                return True
+        return False
+    levels = book['bid_levels']
+    for p in book['bid_prices'].irange(minimum=price, reverse=True):
+        available += levels[p].total
+        if available >= qty:
+            return True
+    return False
+
+ORDER_TYPES = ("market", "limit", "ioc", "fok")
+
+# Source for the matching core on ticks/lots. Placeholders are filled per (side, order type),
+# so the side, price-limit and IOC branches are fixed at generation time, not tested per fill.
+# A generated matcher takes (book, price, qty) and returns (fills, remaining), each fill being
+# (maker_order_id, trade_lots, price_ticks, maker_remaining_lots). The caller handles all IO.
+_MATCHER_TEMPLATE = """
+def matcher(book, price, qty):
+    fills = []
+    remaining = qty
+    contra_levels = book[{contra_levels!r}]
+    while remaining > 0:
+        match_price = book[{best_key!r}]
+        if {stop_condition}:
+            break
+        level = contra_levels[match_price]
+
+        # Execute trade with top-of-book (FIFO)
+        maker = level.head
+        trade_qty = min(remaining, maker.qty)
+        maker.qty -= trade_qty
+        level.total -= trade_qty
+        remaining -= trade_qty
+        fills.append((maker.order_id, trade_qty, match_price, maker.qty))
+
+        if maker.qty == 0:
+            level.unlink(maker)
+            del order_map[maker.order_id]
+            if level.head is None:
+                # Remove empty price level
+                remove_level(book, {contra_side!r}, match_price)
+{ioc_exit}
+    return fills, remaining
+"""
+
+def _gen_matcher(side: str, typ: str):
+    """
+    Generate the matching loop specialized for one (side, order type) combination.
+    """
+    buy = side == "buy"
+    if typ == "market":
+        stop_condition = "match_price is None"
+    else:
+        stop_condition = "match_price is None or match_price %s price" % (">" if buy else "<")
+    src = _MATCHER_TEMPLATE.format(
+        contra_levels='ask_levels' if buy else 'bid_levels',
+        best_key='best_ask' if buy else 'best_bid',
+        contra_side="sell" if buy else "buy",
+        stop_condition=stop_condition,
+        # IOC cancels any remaining immediately after the first execution
+        ioc_exit="        break" if typ == "ioc" else "")
+    namespace: Dict[str, object] = {}
+    # Module globals, so generated code resolves order_map/remove_level like any function here
+    exec(compile(src, f"<matcher {side}/{typ}>", "exec"), globals(), namespace)
+    return namespace["matcher"]
+
+# One specialized matcher per (side, order type); FOK matches like a limit order once its precheck passed
+_matcher_cache = {(side, typ): _gen_matcher(side, typ) for side in ("buy", "sell") for typ in ORDER_TYPES}
+
+def book_submit(symbol: str, side: str, typ: str, price, qty: int, order_id: str, username: str):
+    """
+    In-memory part of order submission, run where the symbol's book lives.
+    Returns (status, fills, remaining); status is "filled", "open", "cancelled",
+    or "killed" when the FOK precheck fails.
+    """
+    book = get_order_book(symbol)
+    # Pre-check for FOK: ensure full fill is possible
+    if typ == "fok" and not can_fill(book, side, price, qty):
+        return "killed", [], qty
+    fills, remaining = _matcher_cache[(side, typ)](book, price, qty)
+    if remaining == 0:
+        return "filled", fills, 0
+    if typ == "limit" and price is not None:
+        # Insert remaining as resting limit order
+        level = get_or_create_level(book, side, price)
+        node = RestingOrder(order_id, remaining, username, symbol, side)
+        level.append(node)
+        order_map[order_id] = node
+        return "open", fills, remaining
+    # IOC or market orders cancel any leftover immediately
+    return "cancelled", fills, remaining
+
+def book_cancel(order_id: str, username: str) -> bool:
+    """
+    Remove a resting order from its book; False if it is not resting or not owned by `username`.
+    """
+    node = order_map.get(order_id)
+    if node is None or node.user != username:
+        return False
+    del order_map[order_id]
+    book = get_order_book(node.symbol)
+    level = node.level
+    level.unlink(node)
+    if level.head is None:
+        remove_level(book, node.side, level.price)
+    return True
+
+async def run_on_book(symbol: str, fn, *args):
     """
-    for ws in list(trade_subscribers):
+    Run a book command on the shard owning `symbol`, or in-process.
+
+    Book commands are synchronous and must stay await-free: in-process, the event loop
+    runs each one to completion before any other, which is what makes it the single
+    writer of the books (no lock is needed, and an await inside one would break that).
+    """
+    if not shards:
+        return fn(*args)
+    index = hash(symbol) % len(shards)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(shards[index], fn, *args)
+    except BrokenProcessPool:
+        # The shard process died and took its books with it; it is not restarted
+        # silently with empty books, every order for its symbols is refused instead
+        logging.error("Matching shard %d is down; orders for %s are rejected", index, symbol)
+        raise HTTPException(status_code=503,
+                            detail="Matching engine for this symbol is unavailable; its order book was lost")
+
+async def flush_writes(batch: List[tuple]):
+    """
+    Persist a batch of queued writes: one insert_many and one bulk_write per collection.
+    """
+    inserts: Dict[str, List[dict]] = {}
+    updates: Dict[str, Dict[str, dict]] = {}  # collection -> order_id -> merged "$set"
+    for coll, op, doc in batch:
+        if op == "insert":
+            inserts.setdefault(coll, []).append(doc)
+        else:
+            order_id, fields = doc
+            updates.setdefault(coll, {}).setdefault(order_id, {}).update(fields)
+    # Inserts go first so updates in the same batch find their documents
+    for coll, docs in inserts.items():
+        await write_collections[coll].insert_many(docs, ordered=False)
+    for coll, by_id in updates.items():
+        await write_collections[coll].bulk_write(
+            [UpdateOne({"order_id": oid}, {"$set": fields}) for oid, fields in by_id.items()],
+            ordered=False)
+
+async def writer_loop():
+    """
+    Background consumer draining write_q in batches.
+    """
+    while True:
+        batch = [await write_q.get()]
+        try:
+            while len(batch) < WRITE_BATCH_SIZE:
+                batch.append(await asyncio.wait_for(write_q.get(), WRITE_BATCH_TIMEOUT))
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await flush_writes(batch)
+        except Exception:
+            logging.exception("Failed to persist %d queued writes", len(batch))
+        finally:
+            for _ in batch:
+                write_q.task_done()
+
+@app.on_event("startup")
+async def start_writer():
+    """
+    Launch the background Mongo writer.
+    """
+    global writer_task
+    writer_task = asyncio.create_task(writer_loop())
+
+@app.on_event("startup")
+async def start_shards():
+    """
+    Start one matching worker process per shard.
+    """
+    if MATCH_SHARDS < 2:
+        # A single shard adds IPC cost without any parallelism
+        return
+    # spawn: never fork a process that already runs an event loop and driver threads
+    ctx = multiprocessing.get_context("spawn")
+    for _ in range(MATCH_SHARDS):
+        shards.append(ProcessPoolExecutor(max_workers=1, mp_context=ctx))
+    # Warm the workers up so the first orders don't pay for process start
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(shard, os.getpid) for shard in shards))
+
+@app.on_event("shutdown")
+async def stop_shards():
+    """
+    Shut down the matching worker processes.
+    """
+    for shard in shards:
+        shard.shutdown(wait=True)
+
+@app.on_event("startup")
+async def create_indexes():
+    """
+    Ensure the indexes used by order updates and trade queries exist.
+    """
+    await orders_collection.create_index("order_id", unique=True)
+    await trades_collection.create_index([("symbol", 1), ("timestamp", -1)])
+
+@app.on_event("shutdown")
+async def stop_writer():
+    """
+    Stop the background writer once the queue is drained.
+    """
+    # Flush whatever is still queued before stopping the writer
+    await write_q.join()
+    writer_task.cancel()
+
+async def broadcast_trades(trade_events: List[dict]):
+    """
+    Broadcast a batch of trade events to all WebSocket subscribers as one frame each.
+    """
+    if not trade_subscribers:
+        return
+    # Raw bytes skip the JSON re-encoding done by send_json/send_text
+    payload = orjson.dumps(trade_events)
+    # Snapshot for pairing results with sockets; sends run concurrently so one
+    # slow client does not delay the others
+    targets = tuple(trade_subscribers)
+    results = await asyncio.gather(*(ws.send_bytes(payload) for ws in targets),
+                                   return_exceptions=True)
+    for ws, result in zip(targets, results):
+        if isinstance(result, Exception):
+            trade_subscribers.discard(ws)
+
+async def broadcaster_loop():
+    """
+    Background consumer debouncing queued trades into batched broadcasts.
+    """
+    while True:
+        events = list(await broadcast_q.get())
+        await asyncio.sleep(BROADCAST_DEBOUNCE)
+        while not broadcast_q.empty():
+            events.extend(broadcast_q.get_nowait())
         try:
-            await ws.send_json(trade_event)
+            await broadcast_trades(events)
         except Exception:
-            trade_subscribers.remove(ws)
+            logging.exception("Failed to broadcast %d trades", len(events))
+
+@app.on_event("startup")
+async def start_broadcaster():
+    """
+    Launch the background trade broadcaster.
+    """
+    global broadcaster_task
+    broadcaster_task = asyncio.create_task(broadcaster_loop())
+
+@app.on_event("shutdown")
+async def stop_broadcaster():
+    """
+    Stop the background trade broadcaster.
+    """
+    broadcaster_task.cancel()
 
 @app.websocket("/ws/trades")
 async def trades_ws(websocket: WebSocket):
@@ -97,141 +575,136 @@ async def trades_ws(websocket: WebSocket):
     WebSocket endpoint for streaming real-time trade execution events:contentReference[oaicite:2]{index=2}.
     """
     await websocket.accept()
-    trade_subscribers.append(websocket)
+    trade_subscribers.add(websocket)
     try:
         while True:
-            await asyncio.sleep(10)  # keep alive
-    except Exception:
-        trade_subscribers.remove(websocket)
+            # Suspends until the client sends or disconnects; liveness is checked by
+            # the server's protocol-level ping/pong (uvicorn ws_ping_interval).
+            # Client frames, text or binary, are ignored.
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    finally:
+        trade_subscribers.discard(websocket)
 
 @app.post("/submit_order")
 async def submit_order(order: OrderIn, user: dict = Depends(get_current_user)):
     """
     Submit a new order (market, limit, IOC, or FOK) with price-time priority matching.
     """
-    symbol = order.symbol.upper()
-    side = order.side.lower()
-    typ = order.order_type.lower()
-    qty = order.quantity
+    return await execute_order(user, order.symbol, order.order_type, order.side,
+                               order.quantity, order.price)
+
+@app.post("/submit_order_fast")
+async def submit_order_fast(request: Request, user: dict = Depends(get_current_user)):
+    """
+    Submit a new order from a raw JSON body, skipping Pydantic validation on the hot path.
+    """
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="Order must be a JSON object")
+    symbol = body.get("symbol")
+    order_type = body.get("order_type")
+    side = body.get("side")
+    quantity = body.get("quantity")
+    price = body.get("price")
+    if not (isinstance(symbol, str) and isinstance(order_type, str) and isinstance(side, str)):
+        raise HTTPException(status_code=400, detail="symbol, order_type and side must be strings")
+    if not isinstance(quantity, (int, float)) or isinstance(quantity, bool):
+        raise HTTPException(status_code=400, detail="quantity must be a number")
+    if price is not None and (not isinstance(price, (int, float)) or isinstance(price, bool)):
+        raise HTTPException(status_code=400, detail="price must be a number")
+    return await execute_order(user, symbol, order_type, side, quantity, price)
+
+async def execute_order(user: dict, symbol: str, order_type: str, side: str,
+                        quantity: float, limit_price: Union[float, None]):
+    """
+    Validate and match an order shared by both submit endpoints.
+    """
+    symbol = symbol.upper()
+    side = side.lower()
+    typ = order_type.lower()
+    # Normalize to integer lots/ticks at ingress
+    qty = to_lots(symbol, quantity)
     if qty <= 0:
         raise HTTPException(status_code=400, detail="Quantity must be positive")
+    if side not in ("buy", "sell"):
+        raise HTTPException(status_code=400, detail="Side must be 'buy' or 'sell'")
+    if typ not in ORDER_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown order type")
     if typ in ["limit", "ioc", "fok"]:
-        if order.price is None:
+        if limit_price is None:
             raise HTTPException(status_code=400, detail="Limit orders require a price")
-        price = order.price
+        price = to_ticks(symbol, limit_price)
+        if price <= 0:
+            raise HTTPException(status_code=400, detail="Price must be positive")
     else:  # market
-        price = None
+        price = limit_price = None
+    tick_scale = ticks_per_unit.get(symbol, DEFAULT_TICKS_PER_UNIT)
+    lot_scale = lots_per_unit.get(symbol, DEFAULT_LOTS_PER_UNIT)
 
     order_id = f"ORDER-{uuid.uuid4()}"
-    timestamp = datetime.datetime.utcnow().isoformat()
-    # Persist new order with status 'open'
-    await orders_collection.insert_one({
+    # Timestamps are stored as integer nanoseconds since the epoch (BSON int64) and
+    # rendered as ISO strings only on the HTTP/WebSocket surfaces
+    timestamp = time.time_ns()
+    # The order document is persisted once, after matching, with its terminal status
+    order_doc = {
         "order_id": order_id, "symbol": symbol, "user": user["username"],
-        "side": side, "type": typ, "quantity": qty, "price": price,
+        "side": side, "type": typ, "quantity": quantity, "price": limit_price,
         "timestamp": timestamp, "status": "open"
-    })
-    book = get_order_book(symbol)
-    trades_executed = []
-    remaining = qty
-
-    # Helper: get best bid/ask using SortedDict.peekitem:contentReference[oaicite:3]{index=3}
-    def get_best_price(bids: SortedDict, asks: SortedDict):
-        best_bid = bids.peekitem(-1)[0] if bids else None  # highest bid
-        best_ask = asks.peekitem(0)[0] if asks else None   # lowest ask
-        return best_bid, best_ask
-
-    # Pre-check for FOK: ensure full fill is possible
-    if typ == "fok":
-        available = 0
-        if side == "buy":
-            for ask_price, queue in book['asks'].items():
-                if price is None or ask_price <= price:
-                    available += sum(o['quantity'] for o in queue)
-        else:
-            for bid_price, queue in book['bids'].items():
-                if price is None or bid_price >= price:
-                    available += sum(o['quantity'] for o in queue)
-        if available < remaining:
-            # Cannot fully fill: cancel order
-            await orders_collection.update_one({"order_id": order_id}, {"$set": {"status": "cancelled"}})
-            return {"order_id": order_id, "status": "cancelled", "filled": False}
-
-    # Matching loop
-    while remaining > 0:
-        best_bid, best_ask = get_best_price(book['bids'], book['asks'])
-        if side == "buy":
-            if not book['asks'] or (price is not None and best_ask > price):
-                break
-            match_price = best_ask
-            queue = book['asks'][match_price]
-        else:
-            if not book['bids'] or (price is not None and best_bid < price):
-                break
-            match_price = best_bid
-            queue = book['bids'][match_price]
-
-        # Execute trade with top-of-book (FIFO)
-        maker_order = queue[0]
-        trade_qty = min(remaining, maker_order['quantity'])
-        maker_order['quantity'] -= trade_qty
-        remaining -= trade_qty
+    }
+    status, fills, remaining = await run_on_book(
+        symbol, book_submit, symbol, side, typ, price, qty, order_id, user["username"])
+    if status == "killed":
+        # FOK could not fully fill: cancel order
+        order_doc["status"] = "cancelled"
+        write_q.put_nowait(("orders", "insert", order_doc))
+        return {"order_id": order_id, "status": "cancelled", "filled": False}
 
-        trade_id = f"TRADE-{uuid.uuid4()}"
+    trades_executed = []
+    # All fills of one order execute together and share one execution timestamp
+    exec_ts = time.time_ns()
+    exec_iso = iso(exec_ts)
+    # Maker updates are collapsed locally before being queued for persistence
+    maker_updates: Dict[str, dict] = {}  # maker order_id -> last "$set" fields
+    for maker_id, trade_qty, match_price, maker_left in fills:
+        trade_id = f"TRADE-{idgen.next_hex()}"
         trade = {
             "trade_id": trade_id,
             "symbol": symbol,
-            "price": match_price,
-            "quantity": trade_qty,
-            "maker_order_id": maker_order['order_id'],
+            "price": match_price / tick_scale,
+            "quantity": trade_qty / lot_scale,
+            "maker_order_id": maker_id,
             "taker_order_id": order_id,
             "aggressor_side": side,
-            "timestamp": datetime.datetime.utcnow().isoformat()
+            "timestamp": exec_iso
         }
         trades_executed.append(trade)
-        await trades_collection.insert_one(trade)
-        await broadcast_trade(trade)
-
-        # Update maker order in DB
-        if maker_order['quantity'] == 0:
-            queue.popleft()
-            await orders_collection.update_one({"order_id": maker_order['order_id']},
-                                            {"$set": {"status": "filled"}})
+        # Record maker order state; only the last update per maker is written
+        if maker_left == 0:
+            maker_updates[maker_id] = {"status": "filled"}
+            order_symbols.pop(maker_id, None)
         else:
-            await orders_collection.update_one({"order_id": maker_order['order_id']},
-                                            {"$set": {"quantity": maker_order['quantity'], "status": "partial"}})
-        if not queue:
-            # Remove empty price level
-            if side == "buy":
-                del book['asks'][match_price]
-            else:
-                del book['bids'][match_price]
-
-        if typ == "ioc":
-            # Cancel any remaining immediately
-            break
+            maker_updates[maker_id] = {"quantity": maker_left / lot_scale, "status": "partial"}
 
-    # Handle any remaining portion of the order
-    if remaining > 0:
-        if typ == "limit":
-            # Insert remaining as resting limit order
-            resting_price = price if price is not None else (match_price if 'match_price' in locals() else None)
-            if resting_price is None:
-                # No resting price (market order with no book), cancel remainder
-                await orders_collection.update_one({"order_id": order_id}, {"$set": {"status": "cancelled"}})
-            else:
-                side_book = book['bids'] if side == "buy" else book['asks']
-                if resting_price not in side_book:
-                    side_book[resting_price] = deque()
-                side_book[resting_price].append({"order_id": order_id, "quantity": remaining})
-                # Update DB with remaining as open
-                await orders_collection.update_one({"order_id": order_id},
-                                                {"$set": {"quantity": remaining, "status": "open"}})
-        else:
-            # IOC or market orders cancel any leftover immediately
-            await orders_collection.update_one({"order_id": order_id}, {"$set": {"status": "cancelled"}})
-    else:
-        # Order fully filled
-        await orders_collection.update_one({"order_id": order_id}, {"$set": {"status": "filled"}})
+    order_doc["status"] = status
+    if status == "open":
+        # Persist remaining as open
+        order_doc["quantity"] = remaining / lot_scale
+        order_symbols[order_id] = symbol
+
+    # Queue persistence; trades are copied (with the raw ns timestamp) so the driver's
+    # "_id" never leaks into responses
+    write_q.put_nowait(("orders", "insert", order_doc))
+    for trade in trades_executed:
+        write_q.put_nowait(("trades", "insert", {**trade, "timestamp": exec_ts}))
+    for mid, fields in maker_updates.items():
+        write_q.put_nowait(("orders", "update", (mid, fields)))
+    if trades_executed:
+        broadcast_q.put_nowait(trades_executed)
 
     return {"order_id": order_id, "trades": trades_executed}
 
@@ -241,23 +714,14 @@ async def cancel_order(cancel: CancelOrder, user: dict = Depends(get_current_use
     Cancel an existing order by ID.
     """
     order_id = cancel.order_id
-    db_order = await orders_collection.find_one({"order_id": order_id})
-    if not db_order:
+    # Only resting orders are cancellable; the owning book checks it is still resting
+    symbol = order_symbols.get(order_id)
+    if symbol is None or not await run_on_book(symbol, book_cancel, order_id, user["username"]):
         raise HTTPException(status_code=404, detail="Order not found")
-    if db_order.get("status") in ["filled", "cancelled"]:
-        raise HTTPException(status_code=400, detail="Order already finalized")
-    symbol = db_order["symbol"]
-    side = db_order["side"]
-    price = db_order["price"]
-    book = get_order_book(symbol)
-    side_book = book['bids'] if side == "buy" else book['asks']
-    if price in side_book:
-        queue = side_book[price]
-        for o in list(queue):
-            if o["order_id"] == order_id:
-                queue.remove(o)
-                break
-        if not queue:
-            del side_book[price]
-    await orders_collection.update_one({"order_id": order_id}, {"$set": {"status": "cancelled"}})
+    order_symbols.pop(order_id, None)
+    write_q.put_nowait(("orders", "update", (order_id, {"status": "cancelled"})))
     return {"order_id": order_id, "status": "cancelled"}
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=8000, ws_ping_interval=20, ws_ping_timeout=20)